@@ -12,11 +12,32 @@ import random
 import traceback # useful for exception handling
 import threading
 
+# Raised by Proxy.forward_request() when the target server cannot be reached or gives no usable answer
+class UpstreamError(Exception):
+    pass
+
+# Raised by Proxy.forward_request() when the target server does not answer in time
+class UpstreamTimeout(UpstreamError):
+    pass
+
+def nonNegativeInt(value: str) -> int:
+        number = int(value)
+        if number < 0:
+            raise argparse.ArgumentTypeError('%s must not be negative' % value)
+        return number
+
+def positiveInt(value: str) -> int:
+        number = int(value)
+        if number <= 0:
+            raise argparse.ArgumentTypeError('%s must be greater than zero' % value)
+        return number
+
 def setupArgumentParser() -> argparse.Namespace:
         parser = argparse.ArgumentParser(
             description='A collection of Network Applications developed for SCC.203.')
-        parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk')
-        subparsers = parser.add_subparsers(help='sub-command help')
+        parser.set_defaults(hostname='lancaster.ac.uk')
+        # Only the web server and proxy live in this file, so one of them has to be chosen
+        subparsers = parser.add_subparsers(help='sub-command help', dest='command', required=True)
 
         parser_w = subparsers.add_parser('web', aliases=['w'], help='run web server')
         parser_w.set_defaults(port=8080)
@@ -28,6 +49,15 @@ def setupArgumentParser() -> argparse.Namespace:
         parser_x.set_defaults(port=8000)
         parser_x.add_argument('--port', '-p', type=int, nargs='?',
                               help='port number to start web server listening on')
+        parser_x.set_defaults(max_age=60, stale_while_revalidate=30, stale_if_error=300, timeout=5)
+        parser_x.add_argument('--max-age', '-m', type=nonNegativeInt,
+                              help='seconds a cached object is served without refreshing')
+        parser_x.add_argument('--stale-while-revalidate', '-r', type=nonNegativeInt,
+                              help='seconds after max-age a stale object is served while it is refreshed in the background')
+        parser_x.add_argument('--stale-if-error', '-e', type=nonNegativeInt,
+                              help='seconds after max-age a stale object is served if the target server cannot be reached')
+        parser_x.add_argument('--timeout', '-t', type=positiveInt,
+                              help='maximum seconds to wait for the target server, including the DNS lookup, before considering the request failed')
         parser_x.set_defaults(func=Proxy)
 
         args = parser.parse_args()
@@ -177,7 +207,20 @@ class Proxy(NetworkApplication):
             # print the request data to the console
             print(request)
             
-            response = self.cache_or_forward_request(request)
+            try:
+                response = self.cache_or_forward_request(request)
+            except UpstreamTimeout:
+                # The target server did not answer in time and there was no usable cached copy
+                traceback.print_exc()
+                response = "HTTP/1.1 504 Gateway Timeout\r\n\r\n".encode()
+            except UpstreamError:
+                # The target server could not be reached and there was no usable cached copy
+                traceback.print_exc()
+                response = "HTTP/1.1 502 Bad Gateway\r\n\r\n".encode()
+            except OSError:
+                # Something went wrong on the proxy itself, e.g. reading the cache
+                traceback.print_exc()
+                response = "HTTP/1.1 500 Internal Server Error\r\n\r\n".encode()
             
             # send the response data to the client
             self.send_response(client_socket, response)
@@ -203,44 +246,211 @@ class Proxy(NetworkApplication):
         # Decode and split (EXTRACTION) the filename from the request and construct a filepath
         filename = request.decode().split(' ')[1].replace("http://", "").replace("/", "")
         filepath = 'cache/' + filename
+        request_type = request.decode().split(' ')[0]
         
         if os.path.exists(filepath):
-            # If the response has been cached, read it from the local file
+            # If the response has been cached, work out how old it is from the time the file was last written
             print("This file exists")
+            age = time.time() - os.path.getmtime(filepath)
             with open(filepath, 'rb') as f:
                 response = f.read()
-            f.close()
+
+            if age <= self.max_age:
+                # Fresh, serve it straight from the cache
+                return response
+
+            if request_type != 'GET':
+                # Only GET is safe to repeat behind the client's back, so other methods never get a stale copy
+                # or a background refresh, they go straight to the target server
+                response = self.forward_request(request, filename)
+                if self.is_ok(response):
+                    self.try_save_to_cache(filepath, response)
+                return response
+
+            if age <= self.max_age + self.stale_while_revalidate:
+                # Stale but within the revalidate window, serve the stale copy now and refresh it in the background
+                print("Serving stale copy while revalidating")
+                self.revalidate_in_background(self.strip_conditional_headers(request), filename, filepath)
+                return response
+
+            if age <= self.max_age + self.stale_if_error and self.has_failed(filepath):
+                # The target server already failed for this object, don't make every client wait on it again,
+                # serve the stale copy now and retry in the background
+                print("Target server failed recently, serving stale copy while retrying")
+                self.revalidate_in_background(self.strip_conditional_headers(request), filename, filepath)
+                return response
+
+            # Too stale to serve straight away, try the target server and fall back to the stale copy if it fails
+            stale_response = response
+            try:
+                response = self.forward_request(self.strip_conditional_headers(request), filename)
+            except UpstreamError:
+                self.record_failure(filepath)
+                if age <= self.max_age + self.stale_if_error:
+                    print("Target server failed, serving stale copy")
+                    return stale_response
+                raise
+            if self.is_server_error(response):
+                self.record_failure(filepath)
+                if age <= self.max_age + self.stale_if_error:
+                    print("Target server returned an error, serving stale copy")
+                    return stale_response
+                # Pass the error on to the client but keep the cached copy
+                return response
+            self.clear_failure(filepath)
+            # Only a full 200 response replaces the cached copy
+            if self.is_ok(response):
+                self.try_save_to_cache(filepath, response)
         else:
             # If the response hasn't been cached, forward the request to the target server and receive the response
-            # forward the request to the target server and receive the response
-            request_type = request.decode().split(' ')[0]
             print("tHIS IS THE REQUEST TYPE: ", request_type)
-            
-            if request_type == 'GET':
-                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_address = (filename, 80)
-                server_socket.connect(server_address)
-                server_socket.send(request)
-                response = server_socket.recv(9000)
-                server_socket.close()
-            
-            else:
 
-                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_address = (filename, 80)
+            response = self.forward_request(request, filename)
+
+            # Save the response to CACHE, but only a full 200 response (not an error or a 304 Not Modified)
+            if self.is_ok(response):
+                self.try_save_to_cache(filepath, response)
+        
+        
+        return response 
+
+    # The forward_request() method sends the request to the target server and returns its response.
+    # The whole exchange, including the DNS lookup, has to finish within self.timeout seconds.
+    def forward_request(self, request, filename):
+        # Don't let a slow or unreachable target server hold up the client
+        deadline = time.monotonic() + self.timeout
+        try:
+            server_address = (self.resolve_host(filename, self.timeout), 80)
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                server_socket.settimeout(self.time_left(deadline))
                 server_socket.connect(server_address)
+                server_socket.settimeout(self.time_left(deadline))
                 server_socket.send(request)
+                server_socket.settimeout(self.time_left(deadline))
                 response = server_socket.recv(9000)
+            finally:
                 server_socket.close()
-
-            
-            # Save the response to CACHE 
-            with open(filepath, 'wb') as f:
+        except socket.timeout as e:
+            raise UpstreamTimeout('%s did not answer in time' % filename) from e
+        except OSError as e:
+            raise UpstreamError('could not reach %s: %s' % (filename, e)) from e
+        # The target server closed the connection without answering
+        if not response:
+            raise UpstreamError('empty response from %s' % filename)
+        return response
+
+    # The resolve_host() method looks up the address of the target server, giving up after timeout seconds.
+    # gethostbyname() has no timeout of its own, so the lookup runs on another thread.
+    def resolve_host(self, hostname, timeout):
+        result = {}
+
+        def lookup():
+            try:
+                result['address'] = socket.gethostbyname(hostname)
+            except OSError as e:
+                result['error'] = e
+
+        lookup_thread = threading.Thread(target=lookup, daemon=True)
+        lookup_thread.start()
+        lookup_thread.join(timeout)
+        if lookup_thread.is_alive():
+            raise socket.timeout('timed out looking up %s' % hostname)
+        if 'error' in result:
+            raise result['error']
+        return result['address']
+
+    # The time_left() method returns the seconds remaining before deadline, raising socket.timeout once it has passed.
+    def time_left(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('timed out waiting for the target server')
+        return remaining
+
+    # The response_status() method returns the status code from the status line of a response, e.g. b'200'.
+    def response_status(self, response):
+        status_line = response.split(b'\r\n', 1)[0].split()
+        if len(status_line) > 1:
+            return status_line[1]
+        return b''
+
+    # The is_ok() method checks for a 200 response, the only kind that is saved to the cache.
+    def is_ok(self, response):
+        return self.response_status(response) == b'200'
+
+    # The is_server_error() method checks the status line of a response for a 5xx error, which should never replace a cached copy.
+    def is_server_error(self, response):
+        return self.response_status(response).startswith(b'5')
+
+    # The strip_conditional_headers() method removes the client's If-* headers from a request,
+    # so refreshing the cache asks for the full object rather than a 304 Not Modified that has no body to cache.
+    def strip_conditional_headers(self, request):
+        conditional_headers = (b'if-none-match:', b'if-modified-since:', b'if-match:', b'if-unmodified-since:', b'if-range:')
+        lines = request.split(b'\r\n')
+        return b'\r\n'.join(line for line in lines if not line.lower().startswith(conditional_headers))
+
+    # The save_to_cache() method writes to a temporary file and renames it, so a reader never sees a half-written object.
+    def save_to_cache(self, filepath, response):
+        temp_path = filepath + '.tmp.%d' % threading.get_ident()
+        try:
+            with open(temp_path, 'wb') as f:
                 f.write(response)
-            f.close()
-        
-        
-        return response 
+            os.replace(temp_path, filepath)
+        except OSError:
+            # Don't leave the half-written temporary file behind in the cache
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    # The record_failure(), clear_failure() and has_failed() methods track which cached objects the target server last failed to refresh.
+    def record_failure(self, filepath):
+        with self.revalidating_lock:
+            self.failed.add(filepath)
+
+    def clear_failure(self, filepath):
+        with self.revalidating_lock:
+            self.failed.discard(filepath)
+
+    def has_failed(self, filepath):
+        with self.revalidating_lock:
+            return filepath in self.failed
+
+    # The try_save_to_cache() method saves a response but only logs a failure, the client should still get a good response
+    # even if the cache can't be written (e.g. the disk is full).
+    def try_save_to_cache(self, filepath, response):
+        try:
+            self.save_to_cache(filepath, response)
+        except OSError:
+            traceback.print_exc()
+
+    # The revalidate_in_background() method refreshes a cached object on another thread, at most one refresh per object at a time.
+    def revalidate_in_background(self, request, filename, filepath):
+        with self.revalidating_lock:
+            if filepath in self.revalidating:
+                return
+            self.revalidating.add(filepath)
+
+        def revalidate():
+            try:
+                response = self.forward_request(request, filename)
+                if self.is_server_error(response):
+                    self.record_failure(filepath)
+                else:
+                    self.clear_failure(filepath)
+                if self.is_ok(response):
+                    self.try_save_to_cache(filepath, response)
+                else:
+                    # Keep the stale copy rather than replacing it with an error or a response without a body
+                    print("Target server did not return a 200, keeping stale copy")
+            except UpstreamError:
+                # Keep the stale copy, the next request will try again in the background
+                self.record_failure(filepath)
+                traceback.print_exc()
+            finally:
+                with self.revalidating_lock:
+                    self.revalidating.discard(filepath)
+
+        threading.Thread(target=revalidate, daemon=True).start()
 
     def send_response(self, client_socket, response):
         
@@ -255,6 +465,17 @@ class Proxy(NetworkApplication):
     # Configurable port number !!
     def __init__(self, args):
         print('Web Server starting on port: %i...' % (args.port))
+        # Cache freshness windows (in seconds)
+        self.max_age = args.max_age
+        self.stale_while_revalidate = args.stale_while_revalidate
+        self.stale_if_error = args.stale_if_error
+        # Maximum time to wait for the target server (in seconds)
+        self.timeout = args.timeout
+        # Objects currently being refreshed in the background
+        self.revalidating = set()
+        self.revalidating_lock = threading.Lock()
+        # Objects the target server last failed to refresh, served stale straight away within the stale-if-error window
+        self.failed = set()
         # calls the run_proxy() method to start the server.
         self.run_proxy()
 